@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import numpy as np
-import matplotlib.pylab as plt
 import healpy as hp
 from rubin_sim.scheduler.model_observatory import ModelObservatory
 from rubin_sim.scheduler.schedulers import CoreScheduler, FilterSchedUzy
@@ -12,22 +11,83 @@ from rubin_sim.scheduler.surveys import (GreedySurvey, BlobSurvey, ScriptedSurve
 from rubin_sim.scheduler import sim_runner
 import rubin_sim.scheduler.detailers as detailers
 import sys
-import subprocess
+import math
 import os
 import argparse
+from functools import lru_cache
 from make_ddf_survey import generate_ddf_scheduled_obs
-from astropy.coordinates import SkyCoord
-from astropy import units as u
-from rubin_sim.utils import _hpid2_ra_dec, angular_separation, gnomonic_project_toxy
+from rubin_sim.utils import angular_separation
 import rubin_sim
 from gen_long_gaps import gen_long_gaps_survey
 # So things don't fail on hyak
 from astropy.utils import iers
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
 
 iers.conf.auto_download = False
 
+# Which nights to run the twilight NEO survey, selected with --neo_night_pattern
+NEO_NIGHT_PATTERNS = {key: np.array(val, dtype=bool) for key, val in
+                      {1: [True], 2: [True, False], 3: [True, False, False],
+                       4: [True, False, False, False],
+                       # 4 on, 4 off
+                       5: [True, True, True, True, False, False, False, False],
+                       # 3 on 4 off
+                       6: [True, True, True, False, False, False, False],
+                       7: [True, True, False, False, False, False]}.items()}
+
+# BlobSurvey kwargs shared by every blob survey, nside is added at build time
+BLOB_SURVEY_PARAMS = {'slew_approx': 7.5, 'filter_change_approx': 140.,
+                      'read_approx': 2., 'min_pair_time': 15., 'search_radius': 30.,
+                      'alt_max': 85., 'az_range': 90., 'flush_time': 30.,
+                      'smoothing_kernel': None, 'seed': 42, 'dither': True,
+                      'twilight_scale': False}
+# Twilight blobs allow shorter pairs
+TWI_BLOB_SURVEY_PARAMS = {**BLOB_SURVEY_PARAMS, 'min_pair_time': 10., 'in_twilight': True}
+
+# One float map per filter, as returned by EuclidOverlapFootprint.return_maps
+HEALMAP_DTYPE = np.dtype([(filtername, float) for filtername in "ugrizy"])
+
+
+def points_in_polygon(x, y, poly_x, poly_y):
+    """Find which points fall inside a polygon using a crossing-number test
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Coordinates of the points to test
+    poly_x, poly_y : np.ndarray
+        The polygon vertices, in order. The last vertex is joined back to the first.
+
+    Returns
+    -------
+    inside : np.ndarray
+        Boolean array, True where the point is inside the polygon
+    """
+    inside = np.zeros(np.size(x), dtype=bool)
+    # Loop over the edges and vectorize over the points, so memory stays
+    # proportional to the number of points rather than points*vertices.
+    for xa, ya, xb, yb in zip(poly_x, poly_y, np.roll(poly_x, -1), np.roll(poly_y, -1)):
+        # Points whose horizontal ray could cross this edge
+        crosses = np.flatnonzero((ya > y) != (yb > y))
+        inside[crosses] ^= x[crosses] < xa + (y[crosses] - ya)*(xb - xa)/(yb - ya)
+    return inside
+
+
+@lru_cache(maxsize=8)
+def load_contour(contour_file):
+    """Read the RA, dec (degrees) vertices of a contour file, once per file.
+
+    The arrays are shared between callers, so they are returned read-only.
+    float32 is plenty for contour vertices and keeps the polygon test cheaper.
+    """
+    names = ['RA', 'dec']
+    types = [float, float]
+    contours = np.genfromtxt(contour_file, dtype=list(zip(names, types)))
+    ra = np.ascontiguousarray(contours['RA'], dtype=np.float32)
+    dec = np.ascontiguousarray(contours['dec'], dtype=np.float32)
+    ra.flags.writeable = False
+    dec.flags.writeable = False
+    return ra, dec
+
 
 class EuclidOverlapFootprint(SkyAreaGeneratorGalplane):
 
@@ -35,19 +95,23 @@ class EuclidOverlapFootprint(SkyAreaGeneratorGalplane):
                            contour_file='EWS.SGC.Mainland.ROI.2022.RADEC.txt',
                            south_limit=-50.):
 
-        names = ['RA', 'dec']
-        types = [float, float]
-        euclid_contours = np.genfromtxt('EWS.SGC.Mainland.ROI.2022.RADEC.txt',
-                                        dtype=list(zip(names, types)))
+        contour_ra, contour_dec = load_contour(contour_file)
 
-        wrap_ra = self.ra + 0
+        # Only run the polygon test on pixels inside a cap that bounds the contour
+        ra0, dec0 = np.mean(contour_ra), np.mean(contour_dec)
+        cap_radius = np.max(angular_separation(ra0, dec0, contour_ra, contour_dec))
+        candidates = np.flatnonzero(angular_separation(ra0, dec0, self.ra, self.dec) < cap_radius)
+
+        # float32 matches the contour and is only used for the crossing test
+        wrap_ra = self.ra[candidates].astype(np.float32)
         wrap_ra[np.where(wrap_ra > 180)] -= 360
 
-        polygon = Polygon(zip(euclid_contours['RA'], euclid_contours['dec']))
-        in_poly = [polygon.contains(Point(x, y)) for x, y in zip(wrap_ra, self.dec)]
+        in_poly = np.zeros(self.ra.size, dtype=bool)
+        in_poly[candidates] = points_in_polygon(wrap_ra, self.dec[candidates].astype(np.float32),
+                                                contour_ra, contour_dec)
 
         # find which map points are inside the contour
-        indx = np.where((np.array(in_poly) == True & (self.pix_labels == "")))
+        indx = np.flatnonzero(in_poly & (self.pix_labels == ""))
         self.pix_labels[indx] = label
         for filtername in filter_ratios:
             self.healmaps[filtername][indx] = filter_ratios[filtername]
@@ -94,11 +158,12 @@ class EuclidOverlapFootprint(SkyAreaGeneratorGalplane):
             Array string labels for each HEALpix
         """
 
+        npix = hp.nside2npix(self.nside)
         # Array to hold the labels for each pixel
-        self.pix_labels = np.zeros(hp.nside2npix(self.nside), dtype="U20")
+        self.pix_labels = np.zeros(npix, dtype="U20")
         self.healmaps = np.zeros(
-            hp.nside2npix(self.nside),
-            dtype=list(zip(["u", "g", "r", "i", "z", "y"], [float] * 7)),
+            npix,
+            dtype=HEALMAP_DTYPE,
         )
 
         # Note, order here matters. Once a HEALpix is set and labled, subsequent add_ methods
@@ -117,11 +182,25 @@ class EuclidOverlapFootprint(SkyAreaGeneratorGalplane):
         return self.healmaps, self.pix_labels
 
 
+def shared_basis_function(cache, bf_class, **kwargs):
+    """Return bf_class(**kwargs) from cache, building it once per unique set of args.
+
+    cache is a dict owned by whoever builds the survey set, so instances are only
+    shared within that set. Only use this for basis functions that keep no
+    survey_features (the masks, M5Diff, Slewtime), since the same instance will
+    be handed to every survey that asks for it.
+    """
+    key = (bf_class, tuple(sorted(kwargs.items())))
+    if key not in cache:
+        cache[key] = bf_class(**kwargs)
+    return cache[key]
+
+
 def gen_GreedySurveys(nside=32, nexp=2, exptime=30., filters=['r', 'i', 'z', 'y'],
                       camera_rot_limits=[-80., 80.],
                       shadow_minutes=60., max_alt=76., moon_distance=30., ignore_obs=['DD', 'twilight_neo'],
                       m5_weight=3., footprint_weight=0.75, slewtime_weight=3.,
-                      stayfilter_weight=3., repeat_weight=-1., footprints=None):
+                      stayfilter_weight=3., repeat_weight=-1., footprints=None, shared_bfs=None):
     """
     Make a quick set of greedy surveys
 
@@ -158,7 +237,12 @@ def gen_GreedySurveys(nside=32, nexp=2, exptime=30., filters=['r', 'i', 'z', 'y'
         The weight on the slewtime basis function
     stayfilter_weight : float (3.)
         The weight on basis function that tries to stay avoid filter changes.
+    shared_bfs : dict (None)
+        Cache for shared_basis_function. Pass the same dict to each generator to share
+        mask basis functions across one survey set. None uses a fresh dict.
     """
+    if shared_bfs is None:
+        shared_bfs = {}
     # Define the extra parameters that are used in the greedy survey. I
     # think these are fairly set, so no need to promote to utility func kwargs
     greed_survey_params = {'block_size': 1, 'smoothing_kernel': None,
@@ -166,29 +250,41 @@ def gen_GreedySurveys(nside=32, nexp=2, exptime=30., filters=['r', 'i', 'z', 'y'
                            'survey_name': 'greedy'}
 
     surveys = []
-    detailer_list = [detailers.CameraRotDetailer(min_rot=np.min(camera_rot_limits), max_rot=np.max(camera_rot_limits))]
+    rot_min, rot_max = min(camera_rot_limits), max(camera_rot_limits)
+    detailer_list = [detailers.CameraRotDetailer(min_rot=rot_min, max_rot=rot_max)]
     detailer_list.append(detailers.Rottep2RotspDesiredDetailer())
 
     for filtername in filters:
-        bfs = []
-        bfs.append((bf.M5DiffBasisFunction(filtername=filtername, nside=nside), m5_weight))
-        bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                              footprint=footprints,
-                                              out_of_bounds_val=np.nan, nside=nside), footprint_weight))
-        bfs.append((bf.SlewtimeBasisFunction(filtername=filtername, nside=nside), slewtime_weight))
-        bfs.append((bf.StrictFilterBasisFunction(filtername=filtername), stayfilter_weight))
-        bfs.append((bf.VisitRepeatBasisFunction(gap_min=0, gap_max=2*60., filtername=None,
-                                                nside=nside, npairs=20), repeat_weight))
+        basis_functions = []
+        weights = []
+        basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                     filtername=filtername, nside=nside))
+        weights.append(m5_weight)
+        basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                         footprint=footprints,
+                                                         out_of_bounds_val=np.nan, nside=nside))
+        weights.append(footprint_weight)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.SlewtimeBasisFunction,
+                                                     filtername=filtername, nside=nside))
+        weights.append(slewtime_weight)
+        basis_functions.append(bf.StrictFilterBasisFunction(filtername=filtername))
+        weights.append(stayfilter_weight)
+        basis_functions.append(bf.VisitRepeatBasisFunction(gap_min=0, gap_max=2*60., filtername=None,
+                                                           nside=nside, npairs=20))
+        weights.append(repeat_weight)
         # Masks, give these 0 weight
-        bfs.append((bf.ZenithShadowMaskBasisFunction(nside=nside, shadow_minutes=shadow_minutes,
-                                                     max_alt=max_alt), 0))
-        bfs.append((bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=moon_distance), 0))
+        basis_functions.append(shared_basis_function(shared_bfs, bf.ZenithShadowMaskBasisFunction, nside=nside,
+                                                     shadow_minutes=shadow_minutes, max_alt=max_alt))
+        weights.append(0)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.MoonAvoidanceBasisFunction, nside=nside,
+                                                     moon_distance=moon_distance))
+        weights.append(0)
+
+        basis_functions.append(shared_basis_function(shared_bfs, bf.FilterLoadedBasisFunction, filternames=filtername))
+        weights.append(0)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.PlanetMaskBasisFunction, nside=nside))
+        weights.append(0)
 
-        bfs.append((bf.FilterLoadedBasisFunction(filternames=filtername), 0))
-        bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0))
-
-        weights = [val[1] for val in bfs]
-        basis_functions = [val[0] for val in bfs]
         surveys.append(GreedySurvey(basis_functions, weights, exptime=exptime, filtername=filtername,
                                      nside=nside, ignore_obs=ignore_obs, nexp=nexp,
                                      detailers=detailer_list, **greed_survey_params))
@@ -204,7 +300,7 @@ def generate_blobs(nside, nexp=2, exptime=30., filter1s=['u', 'u', 'g', 'r', 'i'
                    m5_weight=6., footprint_weight=1.5, slewtime_weight=3.,
                    stayfilter_weight=3., template_weight=12., u_template_weight=24., footprints=None, u_nexp1=True,
                    scheduled_respect=45., good_seeing={'g': 3, 'r': 3, 'i': 3}, good_seeing_weight=3.,
-                   mjd_start=1, repeat_weight=-20):
+                   mjd_start=1, repeat_weight=-20, shared_bfs=None):
     """
     Generate surveys that take observations in blobs.
 
@@ -258,111 +354,134 @@ def generate_blobs(nside, nexp=2, exptime=30., filter1s=['u', 'u', 'g', 'r', 'i'
         Add a detailer to make sure the number of expossures in a visit is always 1 for u observations.
     scheduled_respect : float (45)
         How much time to require there be before a pre-scheduled observation (minutes)
+    shared_bfs : dict (None)
+        Cache for shared_basis_function. Pass the same dict to each generator to share
+        mask basis functions across one survey set. None uses a fresh dict.
     """
+    if shared_bfs is None:
+        shared_bfs = {}
 
     template_weights = {'u': u_template_weight, 'g': template_weight,
                         'r': template_weight, 'i': template_weight,
                         'z': template_weight, 'y': template_weight}
 
-    BlobSurvey_params = {'slew_approx': 7.5, 'filter_change_approx': 140.,
-                          'read_approx': 2., 'min_pair_time': 15., 'search_radius': 30.,
-                          'alt_max': 85., 'az_range': 90., 'flush_time': 30.,
-                          'smoothing_kernel': None, 'nside': nside, 'seed': 42, 'dither': True,
-                          'twilight_scale': False}
+    BlobSurvey_params = {**BLOB_SURVEY_PARAMS, 'nside': nside}
 
     surveys = []
 
-    times_needed = [pair_time, pair_time*2]
+    rot_min, rot_max = min(camera_rot_limits), max(camera_rot_limits)
+    # These detailers keep no state and do not depend on the filters, so every survey can
+    # use the same ones. CameraRotDetailer tracks its own dither state, so each survey gets one.
+    base_detailers = [detailers.Rottep2RotspDesiredDetailer(),
+                      detailers.CloseAltDetailer(),
+                      detailers.FlushForSchedDetailer()]
     for filtername, filtername2 in zip(filter1s, filter2s):
-        detailer_list = []
-        detailer_list.append(detailers.CameraRotDetailer(min_rot=np.min(camera_rot_limits),
-                                                         max_rot=np.max(camera_rot_limits)))
-        detailer_list.append(detailers.Rottep2RotspDesiredDetailer())
-        detailer_list.append(detailers.CloseAltDetailer())
-        detailer_list.append(detailers.FlushForSchedDetailer())
-        # List to hold tuples of (basis_function_object, weight)
-        bfs = []
+        detailer_list = [detailers.CameraRotDetailer(min_rot=rot_min, max_rot=rot_max)] + base_detailers
+        # Look up the total footprint for each filter once and reuse it below
+        fp1 = footprints.get_footprint(filtername)
+        fp2 = footprints.get_footprint(filtername2) if filtername2 is not None else None
+        basis_functions = []
+        weights = []
 
         if filtername2 is not None:
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername, nside=nside), m5_weight/2.))
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername2, nside=nside), m5_weight/2.))
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername, nside=nside))
+            weights.append(m5_weight/2.)
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername2, nside=nside))
+            weights.append(m5_weight/2.)
 
         else:
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername, nside=nside), m5_weight))
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername, nside=nside))
+            weights.append(m5_weight)
 
         if filtername2 is not None:
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                                    footprint=footprints,
-                                                    out_of_bounds_val=np.nan, nside=nside), footprint_weight/2.))
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername2,
-                                                    footprint=footprints,
-                                                    out_of_bounds_val=np.nan, nside=nside), footprint_weight/2.))
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                               footprint=footprints,
+                                                               out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight/2.)
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername2,
+                                                               footprint=footprints,
+                                                               out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight/2.)
         else:
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                                    footprint=footprints,
-                                                    out_of_bounds_val=np.nan, nside=nside), footprint_weight))
-
-        bfs.append((bf.SlewtimeBasisFunction(filtername=filtername, nside=nside), slewtime_weight))
-        bfs.append((bf.StrictFilterBasisFunction(filtername=filtername), stayfilter_weight))
-        bfs.append((bf.VisitRepeatBasisFunction(gap_min=0, gap_max=3*60., filtername=None,
-                                                   nside=nside, npairs=20), repeat_weight))
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                               footprint=footprints,
+                                                               out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight)
+
+        basis_functions.append(shared_basis_function(shared_bfs, bf.SlewtimeBasisFunction,
+                                                     filtername=filtername, nside=nside))
+        weights.append(slewtime_weight)
+        basis_functions.append(bf.StrictFilterBasisFunction(filtername=filtername))
+        weights.append(stayfilter_weight)
+        basis_functions.append(bf.VisitRepeatBasisFunction(gap_min=0, gap_max=3*60., filtername=None,
+                                                              nside=nside, npairs=20))
+        weights.append(repeat_weight)
 
         if filtername2 is not None:
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
-                                                         footprint=footprints.get_footprint(filtername),
-                                                         n_obs=n_obs_template, season=season,
-                                                         season_start_hour=season_start_hour,
-                                                         season_end_hour=season_end_hour), template_weights[filtername]/2.))
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername2, nside=nside,
-                                                         footprint=footprints.get_footprint(filtername2),
-                                                         n_obs=n_obs_template, season=season,
-                                                         season_start_hour=season_start_hour,
-                                                         season_end_hour=season_end_hour), template_weights[filtername2]/2.))
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
+                                                                    footprint=fp1,
+                                                                    n_obs=n_obs_template, season=season,
+                                                                    season_start_hour=season_start_hour,
+                                                                    season_end_hour=season_end_hour))
+            weights.append(template_weights[filtername]/2.)
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername2, nside=nside,
+                                                                    footprint=fp2,
+                                                                    n_obs=n_obs_template, season=season,
+                                                                    season_start_hour=season_start_hour,
+                                                                    season_end_hour=season_end_hour))
+            weights.append(template_weights[filtername2]/2.)
         else:
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
-                                                         footprint=footprints.get_footprint(filtername),
-                                                         n_obs=n_obs_template, season=season,
-                                                         season_start_hour=season_start_hour,
-                                                         season_end_hour=season_end_hour), template_weight))
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
+                                                                    footprint=fp1,
+                                                                    n_obs=n_obs_template, season=season,
+                                                                    season_start_hour=season_start_hour,
+                                                                    season_end_hour=season_end_hour))
+            weights.append(template_weight)
 
         # Insert things for getting good seeing templates
         if filtername2 is not None:
-            if filtername in list(good_seeing.keys()):
-                bfs.append((bf.NGoodSeeingBasisFunction(filtername=filtername, nside=nside, mjd_start=mjd_start,
-                                                            footprint=footprints.get_footprint(filtername),
-                                                            n_obs_desired=good_seeing[filtername]), good_seeing_weight))
-            if filtername2 in list(good_seeing.keys()):
-                bfs.append((bf.NGoodSeeingBasisFunction(filtername=filtername2, nside=nside, mjd_start=mjd_start,
-                                                            footprint=footprints.get_footprint(filtername2),
-                                                            n_obs_desired=good_seeing[filtername2]), good_seeing_weight))
+            if filtername in good_seeing:
+                basis_functions.append(bf.NGoodSeeingBasisFunction(filtername=filtername, nside=nside, mjd_start=mjd_start,
+                                                                       footprint=fp1,
+                                                                       n_obs_desired=good_seeing[filtername]))
+                weights.append(good_seeing_weight)
+            if filtername2 in good_seeing:
+                basis_functions.append(bf.NGoodSeeingBasisFunction(filtername=filtername2, nside=nside, mjd_start=mjd_start,
+                                                                       footprint=fp2,
+                                                                       n_obs_desired=good_seeing[filtername2]))
+                weights.append(good_seeing_weight)
         else:
-            if filtername in list(good_seeing.keys()):
-                bfs.append((bf.NGoodSeeingBasisFunction(filtername=filtername, nside=nside, mjd_start=mjd_start,
-                                                            footprint=footprints.get_footprint(filtername),
-                                                            n_obs_desired=good_seeing[filtername]), good_seeing_weight))
+            if filtername in good_seeing:
+                basis_functions.append(bf.NGoodSeeingBasisFunction(filtername=filtername, nside=nside, mjd_start=mjd_start,
+                                                                       footprint=fp1,
+                                                                       n_obs_desired=good_seeing[filtername]))
+                weights.append(good_seeing_weight)
         # Make sure we respect scheduled observations
-        bfs.append((bf.TimeToScheduledBasisFunction(time_needed=scheduled_respect), 0))
+        basis_functions.append(bf.TimeToScheduledBasisFunction(time_needed=scheduled_respect))
+        weights.append(0)
         # Masks, give these 0 weight
-        bfs.append((bf.ZenithShadowMaskBasisFunction(nside=nside, shadow_minutes=shadow_minutes, max_alt=max_alt,
-                                                         penalty=np.nan, site='LSST'), 0.))
-        bfs.append((bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=moon_distance), 0.))
-        filternames = [fn for fn in [filtername, filtername2] if fn is not None]
-        bfs.append((bf.FilterLoadedBasisFunction(filternames=filternames), 0))
-        if filtername2 is None:
-            time_needed = times_needed[0]
-        else:
-            time_needed = times_needed[1]
-        bfs.append((bf.TimeToTwilightBasisFunction(time_needed=time_needed), 0.))
-        bfs.append((bf.NotTwilightBasisFunction(), 0.))
-        bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0.))
-
-        # unpack the basis functions and weights
-        weights = [val[1] for val in bfs]
-        basis_functions = [val[0] for val in bfs]
-        if filtername2 is None:
-            survey_name = 'blob, %s' % filtername
-        else:
-            survey_name = 'blob, %s%s' % (filtername, filtername2)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.ZenithShadowMaskBasisFunction, nside=nside,
+                                                     shadow_minutes=shadow_minutes, max_alt=max_alt,
+                                                     penalty=np.nan, site='LSST'))
+        weights.append(0.)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.MoonAvoidanceBasisFunction, nside=nside,
+                                                     moon_distance=moon_distance))
+        weights.append(0.)
+        filternames = [filtername] if filtername2 is None else [filtername, filtername2]
+        basis_functions.append(bf.FilterLoadedBasisFunction(filternames=filternames))
+        weights.append(0)
+        time_needed = pair_time if filtername2 is None else 2*pair_time
+        basis_functions.append(bf.TimeToTwilightBasisFunction(time_needed=time_needed))
+        weights.append(0.)
+        basis_functions.append(bf.NotTwilightBasisFunction())
+        weights.append(0.)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.PlanetMaskBasisFunction, nside=nside))
+        weights.append(0.)
+
+        survey_name = 'blob, %s' % ''.join(filternames)
         if filtername2 is not None:
             detailer_list.append(detailers.TakeAsPairsDetailer(filtername=filtername2))
 
@@ -385,7 +504,7 @@ def generate_twi_blobs(nside, nexp=2, exptime=30., filter1s=['r', 'i', 'z', 'y']
                        m5_weight=6., footprint_weight=1.5, slewtime_weight=3.,
                        stayfilter_weight=3., template_weight=12., footprints=None, repeat_night_weight=None,
                        wfd_footprint=None, scheduled_respect=15., repeat_weight=-1.,
-                       night_pattern=None):
+                       night_pattern=None, shared_bfs=None):
     """
     Generate surveys that take observations in blobs.
 
@@ -435,98 +554,119 @@ def generate_twi_blobs(nside, nexp=2, exptime=30., filter1s=['r', 'i', 'z', 'y']
         The weight to place on getting image templates in u-band. Since there
         are so few u-visits, it can be helpful to turn this up a little higher than
         the standard template_weight kwarg.
+    shared_bfs : dict (None)
+        Cache for shared_basis_function. Pass the same dict to each generator to share
+        mask basis functions across one survey set. None uses a fresh dict.
     """
+    if shared_bfs is None:
+        shared_bfs = {}
 
-    BlobSurvey_params = {'slew_approx': 7.5, 'filter_change_approx': 140.,
-                          'read_approx': 2., 'min_pair_time': 10., 'search_radius': 30.,
-                          'alt_max': 85., 'az_range': 90., 'flush_time': 30.,
-                          'smoothing_kernel': None, 'nside': nside, 'seed': 42, 'dither': True,
-                          'twilight_scale': False, 'in_twilight': True}
+    BlobSurvey_params = {**TWI_BLOB_SURVEY_PARAMS, 'nside': nside}
 
     surveys = []
 
-    times_needed = [pair_time, pair_time*2]
+    rot_min, rot_max = min(camera_rot_limits), max(camera_rot_limits)
+    # These detailers keep no state and do not depend on the filters, so every survey can
+    # use the same ones. CameraRotDetailer tracks its own dither state, so each survey gets one.
+    base_detailers = [detailers.Rottep2RotspDesiredDetailer(),
+                      detailers.CloseAltDetailer(),
+                      detailers.FlushForSchedDetailer()]
     for filtername, filtername2 in zip(filter1s, filter2s):
-        detailer_list = []
-        detailer_list.append(detailers.CameraRotDetailer(min_rot=np.min(camera_rot_limits),
-                                                         max_rot=np.max(camera_rot_limits)))
-        detailer_list.append(detailers.Rottep2RotspDesiredDetailer())
-        detailer_list.append(detailers.CloseAltDetailer())
-        detailer_list.append(detailers.FlushForSchedDetailer())
-        # List to hold tuples of (basis_function_object, weight)
-        bfs = []
+        detailer_list = [detailers.CameraRotDetailer(min_rot=rot_min, max_rot=rot_max)] + base_detailers
+        # Look up the total footprint for each filter once and reuse it below
+        fp1 = footprints.get_footprint(filtername)
+        fp2 = footprints.get_footprint(filtername2) if filtername2 is not None else None
+        basis_functions = []
+        weights = []
 
         if filtername2 is not None:
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername, nside=nside), m5_weight/2.))
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername2, nside=nside), m5_weight/2.))
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername, nside=nside))
+            weights.append(m5_weight/2.)
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername2, nside=nside))
+            weights.append(m5_weight/2.)
 
         else:
-            bfs.append((bf.M5DiffBasisFunction(filtername=filtername, nside=nside), m5_weight))
+            basis_functions.append(shared_basis_function(shared_bfs, bf.M5DiffBasisFunction,
+                                                         filtername=filtername, nside=nside))
+            weights.append(m5_weight)
 
         if filtername2 is not None:
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                                  footprint=footprints,
-                                                  out_of_bounds_val=np.nan, nside=nside), footprint_weight/2.))
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername2,
-                                                  footprint=footprints,
-                                                  out_of_bounds_val=np.nan, nside=nside), footprint_weight/2.))
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                             footprint=footprints,
+                                                             out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight/2.)
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername2,
+                                                             footprint=footprints,
+                                                             out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight/2.)
         else:
-            bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                                  footprint=footprints,
-                                                  out_of_bounds_val=np.nan, nside=nside), footprint_weight))
-
-        bfs.append((bf.SlewtimeBasisFunction(filtername=filtername, nside=nside), slewtime_weight))
-        bfs.append((bf.StrictFilterBasisFunction(filtername=filtername), stayfilter_weight))
-        bfs.append((bf.VisitRepeatBasisFunction(gap_min=0, gap_max=2*60., filtername=None,
-                                                nside=nside, npairs=20), repeat_weight))
+            basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                             footprint=footprints,
+                                                             out_of_bounds_val=np.nan, nside=nside))
+            weights.append(footprint_weight)
+
+        basis_functions.append(shared_basis_function(shared_bfs, bf.SlewtimeBasisFunction,
+                                                     filtername=filtername, nside=nside))
+        weights.append(slewtime_weight)
+        basis_functions.append(bf.StrictFilterBasisFunction(filtername=filtername))
+        weights.append(stayfilter_weight)
+        basis_functions.append(bf.VisitRepeatBasisFunction(gap_min=0, gap_max=2*60., filtername=None,
+                                                           nside=nside, npairs=20))
+        weights.append(repeat_weight)
 
         if filtername2 is not None:
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
-                                                    footprint=footprints.get_footprint(filtername),
-                                                    n_obs=n_obs_template, season=season,
-                                                    season_start_hour=season_start_hour,
-                                                    season_end_hour=season_end_hour), template_weight/2.))
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername2, nside=nside,
-                                                    footprint=footprints.get_footprint(filtername2),
-                                                    n_obs=n_obs_template, season=season,
-                                                    season_start_hour=season_start_hour,
-                                                    season_end_hour=season_end_hour), template_weight/2.))
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
+                                                               footprint=fp1,
+                                                               n_obs=n_obs_template, season=season,
+                                                               season_start_hour=season_start_hour,
+                                                               season_end_hour=season_end_hour))
+            weights.append(template_weight/2.)
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername2, nside=nside,
+                                                               footprint=fp2,
+                                                               n_obs=n_obs_template, season=season,
+                                                               season_start_hour=season_start_hour,
+                                                               season_end_hour=season_end_hour))
+            weights.append(template_weight/2.)
         else:
-            bfs.append((bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
-                                                    footprint=footprints.get_footprint(filtername),
-                                                    n_obs=n_obs_template, season=season,
-                                                    season_start_hour=season_start_hour,
-                                                    season_end_hour=season_end_hour), template_weight))
+            basis_functions.append(bf.NObsPerYearBasisFunction(filtername=filtername, nside=nside,
+                                                               footprint=fp1,
+                                                               n_obs=n_obs_template, season=season,
+                                                               season_start_hour=season_start_hour,
+                                                               season_end_hour=season_end_hour))
+            weights.append(template_weight)
         if repeat_night_weight is not None:
-            bfs.append((bf.AvoidLongGapsBasisFunction(nside=nside, filtername=None,
-                                                          min_gap=0., max_gap=10./24., ha_limit=3.5,
-                                                          footprint=wfd_footprint), repeat_night_weight))
+            basis_functions.append(bf.AvoidLongGapsBasisFunction(nside=nside, filtername=None,
+                                                                     min_gap=0., max_gap=10./24., ha_limit=3.5,
+                                                                     footprint=wfd_footprint))
+            weights.append(repeat_night_weight)
         # Make sure we respect scheduled observations
-        bfs.append((bf.TimeToScheduledBasisFunction(time_needed=scheduled_respect), 0))
+        basis_functions.append(bf.TimeToScheduledBasisFunction(time_needed=scheduled_respect))
+        weights.append(0)
         # Masks, give these 0 weight
-        bfs.append((bf.ZenithShadowMaskBasisFunction(nside=nside, shadow_minutes=shadow_minutes, max_alt=max_alt,
-                                                     penalty=np.nan, site='LSST'), 0.))
-        bfs.append((bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=moon_distance), 0.))
-        filternames = [fn for fn in [filtername, filtername2] if fn is not None]
-        bfs.append((bf.FilterLoadedBasisFunction(filternames=filternames), 0))
-        if filtername2 is None:
-            time_needed = times_needed[0]
-        else:
-            time_needed = times_needed[1]
-        bfs.append((bf.TimeToTwilightBasisFunction(time_needed=time_needed, alt_limit=12), 0.))
-        bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0.))
+        basis_functions.append(shared_basis_function(shared_bfs, bf.ZenithShadowMaskBasisFunction, nside=nside,
+                                                     shadow_minutes=shadow_minutes, max_alt=max_alt,
+                                                     penalty=np.nan, site='LSST'))
+        weights.append(0.)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.MoonAvoidanceBasisFunction, nside=nside,
+                                                     moon_distance=moon_distance))
+        weights.append(0.)
+        filternames = [filtername] if filtername2 is None else [filtername, filtername2]
+        basis_functions.append(bf.FilterLoadedBasisFunction(filternames=filternames))
+        weights.append(0)
+        time_needed = pair_time if filtername2 is None else 2*pair_time
+        basis_functions.append(bf.TimeToTwilightBasisFunction(time_needed=time_needed, alt_limit=12))
+        weights.append(0.)
+        basis_functions.append(shared_basis_function(shared_bfs, bf.PlanetMaskBasisFunction, nside=nside))
+        weights.append(0.)
 
         # Let's turn off twilight blobs on nights where we are 
         # doing NEO hunts
-        bfs.append((bf.NightModuloBasisFunction(pattern=night_pattern), 0))
+        basis_functions.append(bf.NightModuloBasisFunction(pattern=night_pattern))
+        weights.append(0)
 
-        # unpack the basis functions and weights
-        weights = [val[1] for val in bfs]
-        basis_functions = [val[0] for val in bfs]
-        if filtername2 is None:
-            survey_name = 'blob_twi, %s' % filtername
-        else:
-            survey_name = 'blob_twi, %s%s' % (filtername, filtername2)
+        survey_name = 'blob_twi, %s' % ''.join(filternames)
         if filtername2 is not None:
             detailer_list.append(detailers.TakeAsPairsDetailer(filtername=filtername2))
         surveys.append(BlobSurvey(basis_functions, weights, filtername1=filtername, filtername2=filtername2,
@@ -541,11 +681,10 @@ def generate_twi_blobs(nside, nexp=2, exptime=30., filter1s=['r', 'i', 'z', 'y']
 def ddf_surveys(detailers=None, season_frac=0.2, euclid_detailers=None):
     obs_array = generate_ddf_scheduled_obs(season_frac=season_frac)
 
-    euclid_obs = np.where((obs_array['note'] == 'DD:EDFS_b') | (obs_array['note'] == 'DD:EDFS_a'))[0]
-    all_other = np.where((obs_array['note'] != 'DD:EDFS_b') & (obs_array['note'] != 'DD:EDFS_a'))[0]
+    euclid_obs = np.isin(obs_array['note'], ['DD:EDFS_a', 'DD:EDFS_b'])
 
     survey1 = ScriptedSurvey([], detailers=detailers)
-    survey1.set_script(obs_array[all_other])
+    survey1.set_script(obs_array[~euclid_obs])
 
     survey2 = ScriptedSurvey([], detailers=euclid_detailers)
     survey2.set_script(obs_array[euclid_obs])
@@ -553,22 +692,62 @@ def ddf_surveys(detailers=None, season_frac=0.2, euclid_detailers=None):
     return [survey1, survey2]
 
 
+@lru_cache(maxsize=8)
+def all_sky_ra_dec(nside):
+    """RA and dec (radians) of every HEALpix at nside, computed once per nside.
+
+    The arrays are shared between callers, so they are returned read-only.
+    """
+    theta, phi = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)))
+    ra = phi
+    dec = 0.5*np.pi - theta
+    ra.flags.writeable = False
+    dec.flags.writeable = False
+    return ra, dec
+
+
 def ecliptic_target(nside=32, dist_to_eclip=40., dec_max=30., mask=None):
     """Generate a target_map for the area around the ecliptic
+
+    Returns a uint8 map of 0/1 if mask is None, otherwise good*mask, which
+    takes the dtype of mask.
     """
 
-    ra, dec = _hpid2_ra_dec(nside, np.arange(hp.nside2npix(nside)))
-    result = np.zeros(ra.size)
-    coord = SkyCoord(ra=ra*u.rad, dec=dec*u.rad)
-    eclip_lat = coord.barycentrictrueecliptic.lat.radian
-    good = np.where((np.abs(eclip_lat) < np.radians(dist_to_eclip)) &
-                    (dec < np.radians(dec_max)))
-    result[good] += 1
+    ra, dec = all_sky_ra_dec(nside)
+    # Rotate about the x-axis by the obliquity to get sin(ecliptic latitude).
+    # Much faster than a SkyCoord frame transform, and comparing sines means
+    # we never need the arcsin.
+    eps = math.radians(23.4392911)
+    sin_eclip_lat = math.cos(eps)*np.sin(dec) - math.sin(eps)*np.cos(dec)*np.sin(ra)
+    eclip_lim = math.sin(math.radians(dist_to_eclip))
+    dec_lim = math.radians(dec_max)
+    # Work in place to avoid full-sky temporaries
+    np.abs(sin_eclip_lat, out=sin_eclip_lat)
+    good = sin_eclip_lat < eclip_lim
+    good &= dec < dec_lim
+
+    if mask is None:
+        return good.astype(np.uint8)
+    # Multiplying the boolean mask through gives the float map in one step
+    return good * mask
+
 
-    if mask is not None:
-        result *= mask
+# ecliptic_target maps already built, see cached_ecliptic_target
+_ecliptic_target_cache = {}
 
-    return result
+
+def cached_ecliptic_target(nside=32, dist_to_eclip=40., dec_max=30., mask=None):
+    """ecliptic_target, memoized on the arguments and the contents of mask.
+
+    The maps are shared between callers, so they are returned read-only.
+    """
+    mask_key = None if mask is None else (mask.dtype.str, np.ascontiguousarray(mask).tobytes())
+    key = (nside, dist_to_eclip, dec_max, mask_key)
+    if key not in _ecliptic_target_cache:
+        footprint = ecliptic_target(nside=nside, dist_to_eclip=dist_to_eclip, dec_max=dec_max, mask=mask)
+        footprint.flags.writeable = False
+        _ecliptic_target_cache[key] = footprint
+    return _ecliptic_target_cache[key]
 
 
 def generate_twilight_neo(nside, night_pattern=None, nexp=1, exptime=15,
@@ -577,48 +756,63 @@ def generate_twilight_neo(nside, night_pattern=None, nexp=1, exptime=15,
                           time_needed=10, footprint_mask=None,
                           footprint_weight=0.1, slewtime_weight=3.,
                           stayfilter_weight=3., area_required=None,
-                          filters='riz', n_repeat=3, sun_alt_limit=-14.8):
+                          filters='riz', n_repeat=3, sun_alt_limit=-14.8, shared_bfs=None):
     # XXX finish eliminating magic numbers and document this one
+    if shared_bfs is None:
+        shared_bfs = {}
     slew_estimate = 4.5
     survey_name = 'twilight_neo'
-    footprint = ecliptic_target(nside=nside, mask=footprint_mask)
-    constant_fp = ConstantFootprint()
+    footprint = cached_ecliptic_target(nside=nside, mask=footprint_mask)
+    constant_fp = ConstantFootprint(nside=nside)
     for filtername in filters:
         constant_fp.set_footprint(filtername, footprint)
 
+    # These basis functions do not depend on the filter and keep no survey_features,
+    # so every survey can use the same ones. They all have zero weight.
+    shared_basis_functions = [# Need a toward the sun, reward high airmass, with an airmass cutoff basis function.
+                              bf.NearSunTwilightBasisFunction(nside=nside, max_airmass=max_airmass),
+                              shared_basis_function(shared_bfs, bf.ZenithShadowMaskBasisFunction, nside=nside,
+                                                    shadow_minutes=60., max_alt=76.),
+                              shared_basis_function(shared_bfs, bf.MoonAvoidanceBasisFunction,
+                                                    nside=nside, moon_distance=30.),
+                              shared_basis_function(shared_bfs, bf.PlanetMaskBasisFunction, nside=nside),
+                              shared_basis_function(shared_bfs, bf.SolarElongationMaskBasisFunction,
+                                                    min_elong=0., max_elong=60.,
+                                                    nside=nside),
+                              #bf.Sun_alt_limit_basis_function(alt_limit=-15),
+                              #bf.Time_in_twilight_basis_function(time_needed=time_needed),
+                              bf.NightModuloBasisFunction(pattern=night_pattern),
+                              # Do not attempt unless the sun is getting high
+                              bf.SunAltHighLimitBasisFunction(alt_limit=sun_alt_limit)]
+
     surveys = []
+    rot_min, rot_max = min(camera_rot_limits), max(camera_rot_limits)
+    # These detailers keep no state and do not depend on the filters, so every survey can
+    # use the same ones. CameraRotDetailer tracks its own dither state, so each survey gets one.
+    base_detailers = [detailers.CloseAltDetailer(),
+                      # Should put in a detailer so things start at lowest altitude
+                      detailers.TwilightTripleDetailer(slew_estimate=slew_estimate, n_repeat=n_repeat)]
     for filtername in filters:
-        detailer_list = []
-        detailer_list.append(detailers.CameraRotDetailer(min_rot=np.min(camera_rot_limits), max_rot=np.max(camera_rot_limits)))
-        detailer_list.append(detailers.CloseAltDetailer())
-        # Should put in a detailer so things start at lowest altitude
-        detailer_list.append(detailers.TwilightTripleDetailer(slew_estimate=slew_estimate, n_repeat=n_repeat))
-        bfs = []
-
-        bfs.append((bf.FootprintBasisFunction(filtername=filtername,
-                                                footprint=constant_fp,
-                                                out_of_bounds_val=np.nan,
-                                                nside=nside), footprint_weight))
-
-        bfs.append((bf.SlewtimeBasisFunction(filtername=filtername, nside=nside), slewtime_weight))
-        bfs.append((bf.StrictFilterBasisFunction(filtername=filtername), stayfilter_weight))
-        # Need a toward the sun, reward high airmass, with an airmass cutoff basis function.
-        bfs.append((bf.NearSunTwilightBasisFunction(nside=nside, max_airmass=max_airmass), 0))
-        bfs.append((bf.ZenithShadowMaskBasisFunction(nside=nside, shadow_minutes=60., max_alt=76.), 0))
-        bfs.append((bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=30.), 0))
-        bfs.append((bf.FilterLoadedBasisFunction(filternames=filtername), 0))
-        bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0))
-        bfs.append((bf.SolarElongationMaskBasisFunction(min_elong=0., max_elong=60., nside=nside), 0))
-
-        #bfs.append((bf.Sun_alt_limit_basis_function(alt_limit=-15), 0))
-        #bfs.append((bf.Time_in_twilight_basis_function(time_needed=time_needed), 0))
-        bfs.append((bf.NightModuloBasisFunction(pattern=night_pattern), 0))
-        # Do not attempt unless the sun is getting high
-        bfs.append(((bf.SunAltHighLimitBasisFunction(alt_limit=sun_alt_limit)), 0))
-
-        # unpack the basis functions and weights
-        weights = [val[1] for val in bfs]
-        basis_functions = [val[0] for val in bfs]
+        detailer_list = [detailers.CameraRotDetailer(min_rot=rot_min, max_rot=rot_max)] + base_detailers
+        basis_functions = []
+        weights = []
+
+        basis_functions.append(bf.FootprintBasisFunction(filtername=filtername,
+                                                           footprint=constant_fp,
+                                                           out_of_bounds_val=np.nan,
+                                                           nside=nside))
+        weights.append(footprint_weight)
+
+        basis_functions.append(shared_basis_function(shared_bfs, bf.SlewtimeBasisFunction,
+                                                     filtername=filtername, nside=nside))
+        weights.append(slewtime_weight)
+        basis_functions.append(bf.StrictFilterBasisFunction(filtername=filtername))
+        weights.append(stayfilter_weight)
+        basis_functions.append(bf.FilterLoadedBasisFunction(filternames=filtername))
+        weights.append(0)
+
+        basis_functions.extend(shared_basis_functions)
+        weights.extend([0]*len(shared_basis_functions))
 
         # Set huge ideal pair time and use the detailer to cut down the list of observations to fit twilight?
         surveys.append(BlobSurvey(basis_functions, weights, filtername1=filtername, filtername2=None,
@@ -629,16 +823,68 @@ def generate_twilight_neo(nside, night_pattern=None, nexp=1, exptime=15,
     return surveys
 
 
+def read_git_hash(path):
+    """Return the commit hash checked out in the git repo containing path.
+
+    Reads the .git directory directly rather than spawning git. Returns None
+    if path is not inside a git repo.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(os.path.join(path, '.git')):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    git_dir = os.path.join(path, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules have a .git file pointing at the real git dir
+        with open(git_dir) as f:
+            contents = f.read().strip()
+        if not contents.startswith('gitdir:'):
+            return None
+        git_dir = os.path.join(path, contents[len('gitdir:'):].strip())
+    # A linked worktree keeps its own HEAD, but the branch refs and packed-refs
+    # live in the common git dir named by its commondir file
+    common_dir = git_dir
+    commondir_file = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_file):
+        with open(commondir_file) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+
+    with open(os.path.join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+    if not head.startswith('ref:'):
+        # Detached HEAD
+        return head
+    ref = head.split(':', 1)[1].strip()
+    for ref_dir in (git_dir, common_dir):
+        ref_file = os.path.join(ref_dir, ref)
+        if os.path.isfile(ref_file):
+            with open(ref_file) as f:
+                return f.read().strip()
+    # Otherwise the ref has been packed
+    packed_refs = os.path.join(common_dir, 'packed-refs')
+    if os.path.isfile(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split()[0]
+    return None
+
+
 def run_sched(surveys, survey_length=365.25, nside=32, fileroot='baseline_', verbose=False,
-              extra_info=None, illum_limit=40.):
-    years = np.round(survey_length/365.25)
+              extra_info=None, illum_limit=40., observatory=None):
+    years = int(round(survey_length/365.25))
+    filename = fileroot + '%iyrs.db' % years
     scheduler = CoreScheduler(surveys, nside=nside)
     n_visit_limit = None
     fs = FilterSchedUzy(illum_limit=illum_limit)
-    observatory = ModelObservatory(nside=nside)
+    # Reuse the caller's observatory if there is one, building it is not cheap
+    if observatory is None:
+        observatory = ModelObservatory(nside=nside)
     observatory, scheduler, observations = sim_runner(observatory, scheduler,
                                                       survey_length=survey_length,
-                                                      filename=fileroot+'%iyrs.db' % years,
+                                                      filename=filename,
                                                       delete_past=True, n_visit_limit=n_visit_limit,
                                                       verbose=verbose, extra_info=extra_info,
                                                       filter_scheduler=fs)
@@ -691,54 +937,48 @@ if __name__ == "__main__":
     camera_ddf_rot_limit = 75.
 
     extra_info = {}
-    exec_command = ''
-    for arg in sys.argv:
-        exec_command += ' ' + arg
-    extra_info['exec command'] = exec_command
+    extra_info['exec command'] = ' ' + ' '.join(sys.argv)
     try:
-        extra_info['git hash'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'])
-    except subprocess.CalledProcessError:
-        extra_info['git hash'] = 'Not in git repo'
+        git_hash = read_git_hash(os.getcwd())
+    except OSError:
+        git_hash = None
+    extra_info['git hash'] = git_hash if git_hash is not None else 'Not in git repo'
 
     extra_info['file executed'] = os.path.realpath(__file__)
     try:
         rs_path = rubin_sim.__path__[0]
         hash_file = os.path.join(rs_path, '../', '.git/refs/heads/main')
-        extra_info['rubin_sim git hash'] = subprocess.check_output(['cat', hash_file])
-    except subprocess.CalledProcessError:
+        with open(hash_file) as f:
+            extra_info['rubin_sim git hash'] = f.read().strip()
+    except OSError:
         pass
 
     # Use the filename of the script to name the output database
     if dbroot is None:
-        fileroot = os.path.basename(sys.argv[0]).replace('.py', '') + '_'
+        fileroot = os.path.splitext(os.path.basename(sys.argv[0]))[0] + '_'
     else:
         fileroot = dbroot + '_'
     file_end = 'v2.99_'
 
-    pattern_dict = {1: [True], 2: [True, False], 3: [True, False, False],
-                    4: [True, False, False, False],
-                    # 4 on, 4 off
-                    5: [True, True, True, True, False, False, False, False],
-                    # 3 on 4 off
-                    6: [True, True, True, False, False, False, False],
-                    7: [True, True, False, False, False, False]}
-    neo_night_pattern = pattern_dict[neo_night_pattern]
-    reverse_neo_night_pattern = [not val for val in neo_night_pattern]
+    neo_night_pattern = NEO_NIGHT_PATTERNS[neo_night_pattern]
+    reverse_neo_night_pattern = ~neo_night_pattern
 
     # Modify the footprint
     sky = EuclidOverlapFootprint(nside=nside, smc_radius=4, lmc_radius=6)
     footprints_hp_array, labels = sky.return_maps()
 
-    wfd_indx = np.where((labels == 'lowdust') | (labels == 'LMC_SMC') | (labels == 'virgo'))[0]
-    wfd_footprint = footprints_hp_array['r']*0
-    wfd_footprint[wfd_indx] = 1
+    wfd_mask = np.isin(labels, ['lowdust', 'LMC_SMC', 'virgo'])
+    # make_rolling_footprints wants the indices. int32 is plenty for any HEALpix map we use.
+    wfd_indx = np.flatnonzero(wfd_mask).astype(np.int32)
+    wfd_footprint = wfd_mask.astype(np.uint8)
 
-    footprints_hp = {}
-    for key in footprints_hp_array.dtype.names:
-        footprints_hp[key] = footprints_hp_array[key]
+    # Contiguous per-filter maps rather than strided views into the structured array
+    footprints_hp = {key: np.ascontiguousarray(footprints_hp_array[key])
+                     for key in footprints_hp_array.dtype.names}
 
-    footprint_mask = footprints_hp['r']*0
-    footprint_mask[np.where(footprints_hp['r'] > 0)] = 1
+    footprint_mask = (footprints_hp['r'] > 0).astype(np.uint8)
+    # Everything needed has been copied out, release the footprint generator's maps
+    del sky, footprints_hp_array, labels
 
     repeat_night_weight = None
 
@@ -758,22 +998,26 @@ if __name__ == "__main__":
     # Set up the DDF surveys to dither
     u_detailer = detailers.FilterNexp(filtername='u', nexp=1)
     dither_detailer = detailers.DitherDetailer(per_night=per_night, max_dither=max_dither)
-    details = [detailers.CameraRotDetailer(min_rot=-camera_ddf_rot_limit, max_rot=camera_ddf_rot_limit),
-               dither_detailer, u_detailer, detailers.Rottep2RotspDesiredDetailer()]
-    euclid_detailers = [detailers.CameraRotDetailer(min_rot=-camera_ddf_rot_limit, max_rot=camera_ddf_rot_limit),
-                        detailers.EuclidDitherDetailer(), u_detailer, detailers.Rottep2RotspDesiredDetailer()]
+    cam_rot_detailer = detailers.CameraRotDetailer(min_rot=-camera_ddf_rot_limit, max_rot=camera_ddf_rot_limit)
+    rottep_detailer = detailers.Rottep2RotspDesiredDetailer()
+    details = [cam_rot_detailer, dither_detailer, u_detailer, rottep_detailer]
+    euclid_detailers = [cam_rot_detailer, detailers.EuclidDitherDetailer(), u_detailer, rottep_detailer]
     ddfs = ddf_surveys(detailers=details, season_frac=ddf_season_frac, euclid_detailers=euclid_detailers)
 
-    greedy = gen_GreedySurveys(nside, nexp=nexp, footprints=footprints)
+    # Mask basis functions shared between the surveys built below
+    shared_bfs = {}
+    greedy = gen_GreedySurveys(nside, nexp=nexp, footprints=footprints, shared_bfs=shared_bfs)
     neo = generate_twilight_neo(nside, night_pattern=neo_night_pattern,
                                 filters=neo_filters, n_repeat=neo_repeat,
-                                footprint_mask=footprint_mask)
-    blobs = generate_blobs(nside, nexp=nexp, footprints=footprints, mjd_start=conditions.mjd_start, good_seeing_weight=gsw)
+                                footprint_mask=footprint_mask, shared_bfs=shared_bfs)
+    blobs = generate_blobs(nside, nexp=nexp, footprints=footprints, mjd_start=conditions.mjd_start, good_seeing_weight=gsw,
+                           shared_bfs=shared_bfs)
     twi_blobs = generate_twi_blobs(nside, nexp=nexp,
                                    footprints=footprints,
                                    wfd_footprint=wfd_footprint,
-                                   repeat_night_weight=repeat_night_weight, night_pattern=reverse_neo_night_pattern)
+                                   repeat_night_weight=repeat_night_weight, night_pattern=reverse_neo_night_pattern,
+                                   shared_bfs=shared_bfs)
     surveys = [ddfs, long_gaps, blobs, twi_blobs, neo, greedy]
     run_sched(surveys, survey_length=survey_length, verbose=verbose,
               fileroot=os.path.join(outDir, fileroot+file_end), extra_info=extra_info,
-              nside=nside, illum_limit=illum_limit)
+              nside=nside, illum_limit=illum_limit, observatory=observatory)